@@ -3,14 +3,27 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-# Cần import numpy_financial vì các hàm npv/irr đã bị loại khỏi numpy
-import numpy_financial as npf 
+# Numba (nếu có) dùng để biên dịch các vòng lặp NPV/IRR sang mã máy;
+# chỉ khi thiếu mới cần numpy_financial (npv/irr đã bị loại khỏi numpy),
+# nhờ đó lần khởi động nguội không phải import thêm cả gói npf
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:
+    import numpy_financial as npf
+    NUMBA_AVAILABLE = False
 from google import genai
 from google.genai.errors import APIError
+from dataclasses import dataclass, replace
 from docx import Document
-import io
+import hashlib
+import json
 import re
 
+# Regex gỡ các hàng rào ```json ... ``` quanh phản hồi của Gemini
+# (chấp nhận cả nhãn ngôn ngữ khác như ```python và khoảng trắng thừa)
+_JSON_FENCE = re.compile(r'^\s*```[a-zA-Z]*\s*|\s*```\s*$', re.MULTILINE)
+
 # --- Cấu hình Trang Streamlit ---
 st.set_page_config(
     page_title="App Đánh Giá Phương Án Kinh Doanh",
@@ -24,25 +37,58 @@ st.title("Ứng dụng Đánh giá Phương án Kinh doanh 📈")
 def read_docx_file(uploaded_file):
     """Đọc nội dung văn bản từ file Word."""
     try:
-        # Cần reset con trỏ file nếu nó đã được đọc trước đó
+        # Cần reset con trỏ file nếu nó đã được đọc trước đó;
+        # UploadedFile đã là file-like nên đưa thẳng cho python-docx,
+        # không cần copy toàn bộ bytes qua BytesIO
         uploaded_file.seek(0)
-        doc = Document(io.BytesIO(uploaded_file.read()))
-        full_text = []
-        for para in doc.paragraphs:
-            full_text.append(para.text)
-        return "\n".join(full_text)
+        doc = Document(uploaded_file)
+        return "\n".join(para.text for para in doc.paragraphs)
     except Exception as e:
         return f"Lỗi đọc file Word: {e}"
 
+# --- Client Gemini dùng chung cho cả phiên ---
+@st.cache_resource
+def _get_genai_client(api_key):
+    """Tạo genai.Client một lần và tái sử dụng qua các lần rerun."""
+    return genai.Client(api_key=api_key)
+
+# --- Bộ thông số tài chính đã chuẩn hóa ---
+@dataclass(slots=True, frozen=True)
+class FinParams:
+    """Thông số tài chính trích từ văn bản, đã ép kiểu và chuẩn hóa."""
+    C0: float  # Vốn đầu tư
+    N: int     # Dòng đời dự án (năm)
+    R: float   # Doanh thu hàng năm
+    C: float   # Chi phí hoạt động hàng năm
+    k: float   # WACC (thập phân)
+    t: float   # Thuế suất (thập phân)
+
+    @classmethod
+    def from_dict(cls, d):
+        """Dựng từ dict/Series JSON của Gemini, chuẩn hóa phần trăm."""
+        return cls(
+            C0=float(d.get('Vốn đầu tư', 0)),
+            N=int(d.get('Dòng đời dự án', 0)),
+            R=float(d.get('Doanh thu hàng năm', 0)),
+            C=float(d.get('Chi phí hoạt động hàng năm', 0)),
+            k=_to_decimal(float(d.get('WACC', 0.13))),
+            t=_to_decimal(float(d.get('Thuế suất', 0.20))),
+        )
+
 # --- Hàm gọi API Gemini để trích xuất thông tin (Yêu cầu 1) ---
 @st.cache_data(show_spinner="Đang gửi văn bản và trích xuất thông số tài chính bằng Gemini...")
-def extract_financial_data(doc_text, api_key):
-    """Sử dụng Gemini để trích xuất các thông số tài chính từ văn bản."""
-    
-    if not api_key:
+def extract_financial_data(doc_hash, _doc_text, _api_key):
+    """Sử dụng Gemini để trích xuất các thông số tài chính từ văn bản.
+
+    Cache theo doc_hash (blake2b của văn bản) thay vì hash cả chuỗi
+    doc_text; các tham số có gạch dưới không tham gia khóa cache.
+    """
+
+    if not _api_key:
         raise ValueError("Khóa API không được cung cấp.")
-        
-    client = genai.Client(api_key=api_key)
+
+    doc_text = _doc_text
+    client = _get_genai_client(_api_key)
     model_name = 'gemini-2.5-flash'
     
     # Prompt yêu cầu JSON nguyên mẫu để dễ dàng parse
@@ -76,40 +122,191 @@ def extract_financial_data(doc_text, api_key):
     {doc_text}
     """
     
+    response = None
     try:
         response = client.models.generate_content(
             model=model_name,
             contents=prompt
         )
-        
-        # Xử lý chuỗi JSON trả về
-        json_str = response.text.strip()
-        # Loại bỏ các dấu ```json hoặc ``` có thể có
-        if json_str.startswith("```json"):
-            json_str = json_str[7:]
-        if json_str.endswith("```"):
-            json_str = json_str[:-3]
-        
-        return pd.read_json(io.StringIO(json_str), typ='series')
+
+        # Xử lý chuỗi JSON trả về: gỡ hàng rào ```json/``` nếu có
+        json_str = _JSON_FENCE.sub('', response.text.strip())
+
+        # Payload chỉ có 6 khóa: json.loads là đủ, không cần pandas;
+        # ép kiểu + chuẩn hóa một lần về dataclass có slots
+        return FinParams.from_dict(json.loads(json_str))
     except Exception as e:
-        # Trong trường hợp AI trả về không phải JSON thuần
-        st.error(f"AI không trả về JSON hợp lệ. Nội dung phản hồi: {response.text}")
+        # Trong trường hợp AI trả về không phải JSON thuần (nếu lỗi
+        # ngay lúc gọi API thì chưa có response để hiển thị)
+        if response is not None:
+            st.error(f"AI không trả về JSON hợp lệ. Nội dung phản hồi: {response.text}")
         raise e
 
+# --- Các kernel tính toán biên dịch bằng Numba ---
+# Khai báo chữ ký tường minh để Numba biên dịch ngay lúc import và
+# cache ra đĩa (__pycache__), tránh độ trễ JIT ở lần bấm nút đầu tiên
+if NUMBA_AVAILABLE:
+    @numba.njit('float64(float64, float64[::1])', cache=True)
+    def _npv(rate, cfs):
+        """Tính NPV bằng vòng lặp thuần (Numba tự vector hóa)."""
+        acc = 0.0
+        for i in range(cfs.size):
+            acc += cfs[i] / (1.0 + rate) ** i
+        return acc
+
+    @numba.njit('float64(float64[::1], float64)', cache=True)
+    def _irr_newton(cfs, guess):
+        """Tìm IRR bằng Newton-Raphson, chia đôi khi Newton phân kỳ.
+
+        Với IRR âm sâu Newton từ guess dương hay vọt xuống dưới -1 rồi
+        bò từng bước nhỏ đến hết số vòng; khi đó chuyển sang chia đôi
+        trên (-1, hi): NPV -> +vô cùng khi rate -> -1+ còn NPV(rate
+        lớn) -> cfs[0] < 0, nên với dòng tiền đầu tư (một lần đổi
+        dấu) khung nghiệm luôn tồn tại.
+        """
+        rate = guess
+        for _ in range(100):
+            npv_acc = 0.0
+            deriv = 0.0
+            for i in range(cfs.size):
+                factor = (1.0 + rate) ** i
+                npv_acc += cfs[i] / factor
+                deriv -= i * cfs[i] / (factor * (1.0 + rate))
+            if abs(deriv) < 1e-12:
+                break
+            step = npv_acc / deriv
+            rate -= step
+            if rate <= -1.0:
+                # Giữ lãi suất trong miền hợp lệ (> -100%)
+                rate = -0.999999
+            if abs(step) < 1e-9:
+                return rate
+
+        # Newton không hội tụ: chia đôi trên (-1 + eps, hi)
+        lo = -0.999999
+        hi = 10.0
+        f_lo = _npv(lo, cfs)
+        f_hi = _npv(hi, cfs)
+        # Nới hi nếu nghiệm nằm ngoài 1000%/năm
+        while f_lo * f_hi > 0.0 and hi < 1e6:
+            hi *= 10.0
+            f_hi = _npv(hi, cfs)
+        if f_lo * f_hi > 0.0 or f_lo != f_lo or f_hi != f_hi:
+            return np.nan
+        for _ in range(200):
+            mid = 0.5 * (lo + hi)
+            f_mid = _npv(mid, cfs)
+            if hi - lo < 1e-10:
+                return mid
+            if (f_lo > 0.0) == (f_mid > 0.0):
+                lo = mid
+                f_lo = f_mid
+            else:
+                hi = mid
+        return 0.5 * (lo + hi)
+
+    @numba.njit('UniTuple(float64, 3)(float64[::1], float64)', cache=True)
+    def _all_metrics(cfs, wacc):
+        """Một lần duyệt duy nhất: NPV, PP và DPP (kèm phần nội suy).
+
+        PP/DPP trả về -1.0 khi dòng tiền không bao giờ hoàn vốn.
+        """
+        inv = 1.0 / (1.0 + wacc)
+        factor = 1.0  # hệ số chiết khấu 1/(1+k)^i, cập nhật dần
+        npv_acc = 0.0
+        cum_cf = 0.0
+        cum_dcf = 0.0
+        pp = -1.0
+        dpp = -1.0
+        for i in range(cfs.size):
+            dcf = cfs[i] * factor
+            prev_cum_cf = cum_cf
+            prev_cum_dcf = cum_dcf
+            cum_cf += cfs[i]
+            cum_dcf += dcf
+            npv_acc += dcf
+            # Năm hoàn vốn đầu tiên (tích lũy >= 0) + nội suy phần lẻ
+            if pp < 0.0 and cum_cf >= 0.0:
+                if i == 0:
+                    pp = 0.0
+                elif cfs[i] != 0.0:
+                    pp = i - 1 + (-prev_cum_cf) / cfs[i]
+                else:
+                    pp = float(i)
+            if dpp < 0.0 and cum_dcf >= 0.0:
+                if i == 0:
+                    dpp = 0.0
+                elif dcf != 0.0:
+                    dpp = i - 1 + (-prev_cum_dcf) / dcf
+                else:
+                    dpp = float(i)
+            factor *= inv
+        return npv_acc, pp, dpp
+
+    @numba.njit(
+        'void(float64[::1], float64[::1], float64[::1], float64, int64, '
+        'float64, float64, float64[::1], float64[::1])',
+        parallel=True, cache=True
+    )
+    def _batch_metrics(waccs, revenues, costs, c0, n, tax, depr,
+                       out_npv, out_irr):
+        """Tính NPV/IRR cho cả lô kịch bản (wacc, doanh thu, chi phí).
+
+        Mỗi kịch bản độc lập nên prange chia đều ra các lõi CPU; kết
+        quả ghi vào các mảng out_* cấp phát sẵn. Truyền out_irr rỗng
+        để bỏ qua bước giải IRR (đắt nhất) khi chỉ cần NPV.
+        """
+        want_irr = out_irr.size > 0
+        for s in numba.prange(waccs.size):
+            ebt = revenues[s] - costs[s] - depr
+            tx = max(ebt, 0.0) * tax
+            cf = ebt - tx + depr
+            cfs = np.empty(n + 1)
+            cfs[0] = -c0
+            for i in range(1, n + 1):
+                cfs[i] = cf
+            out_npv[s] = _npv(waccs[s], cfs)
+            if want_irr:
+                out_irr[s] = _irr_newton(cfs, 0.1)
+
+
+# --- Chuẩn hóa phần trăm về thập phân ---
+def _to_decimal(x):
+    """Đưa giá trị phần trăm (vd 13 thay vì 0.13) về dạng thập phân.
+
+    Nhận cả mảng NumPy: dùng np.where branchless cho chế độ quét
+    kịch bản thay vì rẽ nhánh từng phần tử.
+    """
+    if isinstance(x, np.ndarray):
+        return np.where((x > 1) & (x <= 100), x / 100.0, x)
+    return x / 100.0 if 1 < x <= 100 else x
+
 # --- Hàm tính toán Chỉ số Tài chính (Yêu cầu 3) ---
-def calculate_project_metrics(df_cashflow, initial_investment, wacc):
-    """Tính toán NPV, IRR, PP, DPP."""
-    
-    # Dòng tiền từ năm 1 đến năm N
-    cash_flows = df_cashflow['Dòng tiền thuần (CF)'].values
-    
-    # Dòng tiền đầy đủ: [Năm 0 (đầu tư), Năm 1, ..., Năm N]
-    full_cash_flows = np.insert(cash_flows, 0, -initial_investment) 
-    
+def calculate_project_metrics(cf_scalar, project_life, initial_investment, wacc):
+    """Tính toán NPV, IRR, PP, DPP cho dòng tiền đều cf_scalar.
+
+    Với giả định dòng tiền đều hiện tại, chỉ cần CF vô hướng; không
+    phải dựng DataFrame chỉ để đọc lại một cột hằng số.
+    """
+
+    # Dòng tiền đầy đủ: [Năm 0 (đầu tư), Năm 1..N đều bằng cf_scalar]
+    full_cash_flows = np.empty(project_life + 1, dtype=np.float64)
+    full_cash_flows[0] = -initial_investment
+    full_cash_flows[1:] = cf_scalar
+
+    if NUMBA_AVAILABLE:
+        # 1. NPV + 3. PP + 4. DPP trong một lần duyệt, 2. IRR riêng
+        npv_value, pp_val, dpp_val = _all_metrics(full_cash_flows, wacc)
+        irr_value = _irr_newton(full_cash_flows, 0.1)
+        pp = pp_val if pp_val >= 0.0 else 'Không hoàn vốn'
+        dpp = dpp_val if dpp_val >= 0.0 else 'Không hoàn vốn'
+        return npv_value, irr_value, pp, dpp
+
+    # --- Nhánh dự phòng khi không có Numba (NumPy + numpy_financial) ---
     # 1. NPV
     # npf.npv tính NPV bằng cách chiết khấu các CF[1:] và cộng với CF[0]
     npv_value = npf.npv(wacc, full_cash_flows)
-    
+
     # 2. IRR
     try:
         # Dùng npf.irr
@@ -118,14 +315,16 @@ def calculate_project_metrics(df_cashflow, initial_investment, wacc):
         irr_value = np.nan # Không tính được IRR nếu dòng tiền không đổi dấu
 
     # 3. PP (Payback Period - Thời gian hoàn vốn)
+    # argmax trên mask boolean trả về chỉ số True đầu tiên, không cần
+    # materialize mảng chỉ số như np.where
     cumulative_cf = np.cumsum(full_cash_flows)
-    pp_year = np.where(cumulative_cf >= 0)[0]
+    mask_cf = cumulative_cf >= 0
+    pp_year = mask_cf.argmax() if mask_cf.any() else -1
     pp = 'Không hoàn vốn'
-    
-    if pp_year.size > 0:
-        pp_year = pp_year[0]
-        if pp_year == 0: 
-             pp = 0.0 
+
+    if pp_year >= 0:
+        if pp_year == 0:
+             pp = 0.0
         else:
              capital_remaining = abs(cumulative_cf[pp_year-1])
              # Lấy dòng tiền thuần từ năm hoàn vốn
@@ -136,43 +335,52 @@ def calculate_project_metrics(df_cashflow, initial_investment, wacc):
                  pp = float(pp_year)
 
     # 4. DPP (Discounted Payback Period - Thời gian hoàn vốn có chiết khấu)
-    discount_factors = 1 / ((1 + wacc) ** np.arange(0, len(full_cash_flows)))
+    # Chuỗi nhân tích lũy (cumprod) thay cho lũy thừa từng phần tử
+    discount_factors = np.empty(len(full_cash_flows))
+    discount_factors[0] = 1.0
+    discount_factors[1:] = 1.0 / (1.0 + wacc)
+    np.cumprod(discount_factors, out=discount_factors)
     discounted_cf = full_cash_flows * discount_factors
     cumulative_dcf = np.cumsum(discounted_cf)
-    
-    dpp_year = np.where(cumulative_dcf >= 0)[0]
+
+    mask_dcf = cumulative_dcf >= 0
+    dpp_year = mask_dcf.argmax() if mask_dcf.any() else -1
     dpp = 'Không hoàn vốn'
-    
-    if dpp_year.size > 0:
-        dpp_year = dpp_year[0]
+
+    if dpp_year >= 0:
         if dpp_year == 0:
              dpp = 0.0
         else:
              capital_remaining_d = abs(cumulative_dcf[dpp_year-1])
-             dcf_of_payback_year = discounted_cf[dpp_year] 
+             dcf_of_payback_year = discounted_cf[dpp_year]
              if dcf_of_payback_year != 0:
                  dpp = dpp_year - 1 + (capital_remaining_d / dcf_of_payback_year)
              else:
                  dpp = float(dpp_year)
-        
+
     return npv_value, irr_value, pp, dpp
 
 # --- Hàm gọi AI phân tích chỉ số (Yêu cầu 4) ---
-def get_ai_evaluation(metrics_data, wacc_rate, api_key):
-    """Gửi các chỉ số đánh giá dự án đến Gemini API và nhận phân tích."""
-    
-    if not api_key:
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_ai_evaluation(npv, irr, pp, dpp, wacc_rate, _api_key):
+    """Gửi các chỉ số đánh giá dự án đến Gemini API và nhận phân tích.
+
+    Cache 1 giờ theo bộ chỉ số đã làm tròn; cùng một bộ chỉ số thì
+    không gọi lại Gemini. _api_key không tham gia khóa cache.
+    """
+
+    if not _api_key:
         return "Lỗi: Khóa API không được cung cấp."
 
     try:
-        client = genai.Client(api_key=api_key)
-        model_name = 'gemini-2.5-flash'  
+        client = _get_genai_client(_api_key)
+        model_name = 'gemini-2.5-flash'
 
         # Xử lý các giá trị 'Không hoàn vốn' hoặc nan
-        npv_display = f"{metrics_data['NPV']:,.0f} VNĐ"
-        irr_display = f"{metrics_data['IRR']:.2%}" if not np.isnan(metrics_data['IRR']) else "Không tính được"
-        pp_display = f"{metrics_data['PP']:.2f} năm" if isinstance(metrics_data['PP'], float) else metrics_data['PP']
-        dpp_display = f"{metrics_data['DPP']:.2f} năm" if isinstance(metrics_data['DPP'], float) else metrics_data['DPP']
+        npv_display = f"{npv:,.0f} VNĐ"
+        irr_display = f"{irr:.2%}" if not np.isnan(irr) else "Không tính được"
+        pp_display = f"{pp:.2f} năm" if isinstance(pp, float) else pp
+        dpp_display = f"{dpp:.2f} năm" if isinstance(dpp, float) else dpp
 
         prompt = f"""
 Bạn là một chuyên gia phân tích dự án đầu tư có kinh nghiệm. Dựa trên các chỉ số hiệu quả dự án sau, hãy đưa ra nhận xét ngắn gọn, khách quan (khoảng 3-4 đoạn) về khả năng chấp nhận và rủi ro của dự án. 
@@ -214,9 +422,14 @@ uploaded_file = st.file_uploader(
     type=['docx']
 )
 
-# Khởi tạo state để lưu trữ dữ liệu đã trích xuất
+# Khởi tạo state để lưu trữ dữ liệu đã trích xuất, bộ số đã parse và
+# thông báo lỗi (nếu có) của lần parse đó
 if 'extracted_data' not in st.session_state:
     st.session_state['extracted_data'] = None
+if 'parsed' not in st.session_state:
+    st.session_state['parsed'] = None
+if 'parsed_error' not in st.session_state:
+    st.session_state['parsed_error'] = None
 
 # --- Chức năng 1: Lọc dữ liệu bằng AI ---
 if uploaded_file is not None:
@@ -230,7 +443,11 @@ if uploaded_file is not None:
                 if doc_text.startswith("Lỗi đọc file Word"):
                      st.error(doc_text)
                 else:
-                    st.session_state['extracted_data'] = extract_financial_data(doc_text, api_key)
+                    # Khóa cache là hash của văn bản, rẻ hơn hash cả chuỗi
+                    doc_hash = hashlib.blake2b(doc_text.encode(), digest_size=16).hexdigest()
+                    st.session_state['extracted_data'] = extract_financial_data(doc_hash, doc_text, api_key)
+                    # Dữ liệu mới: bỏ bộ số đã parse của lần trước
+                    st.session_state['parsed'] = None
                     st.success("Trích xuất dữ liệu thành công! Vui lòng cuộn xuống để xem kết quả.")
             except APIError:
                 st.error("Lỗi API: Không thể kết nối hoặc xác thực API Key.")
@@ -244,27 +461,38 @@ if st.session_state['extracted_data'] is not None:
     data = st.session_state['extracted_data']
     
     # ****************** Lọc các giá trị số và xử lý ngoại lệ ******************
-    try:
-        # Cố gắng chuyển đổi các giá trị đã trích xuất từ AI
-        initial_investment = float(data.get('Vốn đầu tư', 0))
-        project_life = int(data.get('Dòng đời dự án', 0))
-        annual_revenue = float(data.get('Doanh thu hàng năm', 0))
-        annual_cost = float(data.get('Chi phí hoạt động hàng năm', 0))
-        wacc = float(data.get('WACC', 0.13)) 
-        tax_rate = float(data.get('Thuế suất', 0.20)) 
-        
-        # Đảm bảo WACC và Thuế suất ở dạng thập phân (0 < value < 1)
-        if wacc > 1 and wacc <= 100: wacc /= 100
-        if tax_rate > 1 and tax_rate <= 100: tax_rate /= 100
-        
-        # Kiểm tra tính hợp lệ cơ bản
-        if project_life <= 0:
-            st.error("Dòng đời dự án phải là số nguyên dương (> 0).")
-            project_life = 1
-
-    except Exception as e:
-        st.error(f"Lỗi chuyển đổi dữ liệu trích xuất thành số. Vui lòng kiểm tra lại phản hồi JSON: {e}")
-        initial_investment, project_life, wacc, tax_rate = 0, 1, 0.13, 0.2
+    # Chỉ chuyển đổi một lần cho mỗi lần trích xuất; các rerun sau đọc
+    # thẳng FinParams đã lưu trong session_state
+    if st.session_state['parsed'] is None:
+        error_msg = None
+        try:
+            # extract_financial_data đã trả về FinParams; vẫn chấp nhận
+            # dict/Series (dữ liệu cũ trong session) qua from_dict
+            params = data if isinstance(data, FinParams) else FinParams.from_dict(data)
+
+            # Kiểm tra tính hợp lệ cơ bản
+            if params.N <= 0:
+                error_msg = "Dòng đời dự án phải là số nguyên dương (> 0)."
+                params = replace(params, N=1)
+
+        except Exception as e:
+            error_msg = f"Lỗi chuyển đổi dữ liệu trích xuất thành số. Vui lòng kiểm tra lại phản hồi JSON: {e}"
+            params = FinParams(C0=0.0, N=1, R=0.0, C=0.0, k=0.13, t=0.2)
+
+        st.session_state['parsed'] = params
+        st.session_state['parsed_error'] = error_msg
+
+    # Hiện lại lỗi parse (nếu có) trên mọi lần rerun, không chỉ lần đầu
+    if st.session_state['parsed_error']:
+        st.error(st.session_state['parsed_error'])
+
+    params = st.session_state['parsed']
+    initial_investment = params.C0
+    project_life = params.N
+    annual_revenue = params.R
+    annual_cost = params.C
+    wacc = params.k
+    tax_rate = params.t
 
     # ****************** Hiển thị Thông số ******************
     st.subheader("2. Các Thông số Dự án đã Trích xuất")
@@ -294,36 +522,44 @@ if st.session_state['extracted_data'] is not None:
     if project_life > 0 and initial_investment >= 0:
         try:
             # Tính Khấu hao (theo phương pháp đường thẳng)
-            depreciation = initial_investment / project_life 
-            years = np.arange(1, project_life + 1)
-            
+            depreciation = initial_investment / project_life
+
             # Tính toán dòng tiền hàng năm (Giả định đơn giản: dòng tiền đều)
+            # max() thay cho rẽ nhánh: giữ kiểu float64 và để SIMD hóa
+            # được khi nâng lên kernel theo lô
             EBT = annual_revenue - annual_cost - depreciation
-            Tax = EBT * tax_rate if EBT > 0 else 0
+            Tax = max(EBT, 0.0) * tax_rate
             EAT = EBT - Tax
             # Dòng tiền thuần = Lợi nhuận sau thuế + Khấu hao
             CF = EAT + depreciation
             
-            # Tạo DataFrame cho Dòng tiền
-            cashflow_data = {
-                'Năm': years,
-                'Doanh thu (R)': [annual_revenue] * project_life,
-                'Chi phí HĐ (C)': [annual_cost] * project_life,
-                'Khấu hao (D)': [depreciation] * project_life,
-                'Lợi nhuận trước thuế (EBT)': [EBT] * project_life,
-                'Thuế (Tax)': [Tax] * project_life,
-                'Lợi nhuận sau thuế (EAT)': [EAT] * project_life,
-                'Dòng tiền thuần (CF)': [CF] * project_life
-            }
-            
-            df_cashflow = pd.DataFrame(cashflow_data)
-            
-            st.dataframe(
-                df_cashflow.style.format({
-                    col: '{:,.0f}' for col in df_cashflow.columns if col not in ['Năm']
-                }), 
-                use_container_width=True
-            )
+            # Bảng chỉ để hiển thị (các chỉ số dùng thẳng CF vô hướng)
+            # nên chỉ dựng khi người dùng yêu cầu, không phải mỗi rerun
+            if st.checkbox('Hiện bảng dòng tiền chi tiết', value=True):
+                # Broadcast một hàng hằng số vào mảng float64 thay vì
+                # nhân bản 7 list Python
+                vals = np.empty((project_life, 7), dtype=np.float64)
+                vals[:] = [annual_revenue, annual_cost, depreciation, EBT, Tax, EAT, CF]
+
+                df_cashflow = pd.DataFrame(vals, columns=[
+                    'Doanh thu (R)',
+                    'Chi phí HĐ (C)',
+                    'Khấu hao (D)',
+                    'Lợi nhuận trước thuế (EBT)',
+                    'Thuế (Tax)',
+                    'Lợi nhuận sau thuế (EAT)',
+                    'Dòng tiền thuần (CF)'
+                ])
+                df_cashflow.insert(0, 'Năm', np.arange(1, project_life + 1, dtype=np.int32))
+
+                # Một chuỗi định dạng + subset thay cho dict formatter từng cột
+                st.dataframe(
+                    df_cashflow.style.format(
+                        '{:,.0f}',
+                        subset=pd.IndexSlice[:, df_cashflow.columns.drop('Năm')]
+                    ),
+                    use_container_width=True
+                )
 
             st.markdown("---")
             
@@ -331,11 +567,13 @@ if st.session_state['extracted_data'] is not None:
             st.subheader("4. Các Chỉ số Đánh giá Hiệu quả Dự án")
             
             if wacc > 0:
-                npv, irr, pp, dpp = calculate_project_metrics(df_cashflow, initial_investment, wacc)
+                npv, irr, pp, dpp = calculate_project_metrics(CF, project_life, initial_investment, wacc)
                 
+                # Giữ nguyên NaN để cảnh báo "IRR không thể tính được"
+                # phía dưới còn nhận ra trường hợp này
                 metrics_data = {
                     'NPV': npv,
-                    'IRR': irr if not np.isnan(irr) else 0.0, 
+                    'IRR': irr,
                     'PP': pp,
                     'DPP': dpp
                 }
@@ -362,20 +600,60 @@ if st.session_state['extracted_data'] is not None:
                 if st.button("Yêu cầu AI Phân tích Chỉ số 🧠"):
                     if api_key:
                         with st.spinner('Đang gửi dữ liệu và chờ Gemini phân tích...'):
-                            ai_result = get_ai_evaluation(metrics_data, wacc, api_key)
+                            # Làm tròn các chỉ số để khóa cache ổn định
+                            ai_result = get_ai_evaluation(round(npv, 2), round(irr, 4), pp, dpp, round(wacc, 4), api_key)
                             st.markdown("**Kết quả Phân tích từ Gemini AI:**")
                             st.info(ai_result)
                     else:
                          st.error("Lỗi: Không tìm thấy Khóa API. Vui lòng kiểm tra cấu hình Secrets.")
 
-            except Exception as e:
-                st.error(f"Có lỗi xảy ra khi tính toán chỉ số: {e}. Vui lòng kiểm tra các thông số đầu vào và WACC.")
-        else:
-            st.warning("WACC (Tỷ lệ chiết khấu) phải lớn hơn 0 để tính toán NPV và DPP.")
-
-        # Xử lý trường hợp có thể không tính được IRR (dòng tiền không đổi dấu)
-        if wacc > 0 and 'metrics_data' in locals() and np.isnan(metrics_data['IRR']):
-            st.warning("IRR không thể tính được. Điều này thường xảy ra khi dòng tiền thuần không đổi dấu trong suốt vòng đời dự án (ví dụ: chỉ có dòng tiền dương).")
+                # ****************** Phân tích Độ nhạy ******************
+                if NUMBA_AVAILABLE:
+                    st.markdown("---")
+                    st.subheader("6. Phân tích Độ nhạy (WACC & Doanh thu)")
+
+                    with st.expander("Quét kịch bản WACC / Doanh thu"):
+                        col_a, col_b = st.columns(2)
+                        wacc_delta = col_a.slider("Biên độ WACC (± điểm %)", 1.0, 10.0, 5.0, 0.5)
+                        rev_delta = col_b.slider("Biên độ Doanh thu (± %)", 5.0, 50.0, 20.0, 5.0)
+
+                        # Lưới kịch bản: 3 mức doanh thu x 41 mức WACC,
+                        # trải phẳng thành các mảng 1D cho kernel lô
+                        n_steps = 41
+                        waccs_1d = np.linspace(
+                            max(wacc - wacc_delta / 100, 0.001),
+                            wacc + wacc_delta / 100, n_steps
+                        )
+                        rev_levels = np.array([1 - rev_delta / 100, 1.0, 1 + rev_delta / 100]) * annual_revenue
+                        waccs_grid = np.ascontiguousarray(np.tile(waccs_1d, rev_levels.size))
+                        revs_grid = np.ascontiguousarray(np.repeat(rev_levels, n_steps))
+                        costs_grid = np.full(waccs_grid.size, annual_cost)
+
+                        # Biểu đồ chỉ vẽ NPV; IRR không đổi theo WACC nên
+                        # truyền mảng rỗng để kernel bỏ qua bước giải IRR
+                        out_npv = np.empty(waccs_grid.size)
+                        _batch_metrics(waccs_grid, revs_grid, costs_grid,
+                                       float(initial_investment), project_life,
+                                       tax_rate, depreciation, out_npv,
+                                       np.empty(0))
+
+                        df_sens = pd.DataFrame(
+                            out_npv.reshape(rev_levels.size, n_steps).T,
+                            index=pd.Index(np.round(waccs_1d * 100, 2), name='WACC (%)'),
+                            columns=[f"Doanh thu {p:+.0f}%" for p in (-rev_delta, 0.0, rev_delta)]
+                        )
+                        st.line_chart(df_sens)
+                        st.caption("NPV (VNĐ) theo WACC cho ba mức doanh thu; IRR không đổi theo WACC.")
+
+            else:
+                st.warning("WACC (Tỷ lệ chiết khấu) phải lớn hơn 0 để tính toán NPV và DPP.")
+
+            # Xử lý trường hợp có thể không tính được IRR (dòng tiền không đổi dấu)
+            if wacc > 0 and 'metrics_data' in locals() and np.isnan(metrics_data['IRR']):
+                st.warning("IRR không thể tính được. Điều này thường xảy ra khi dòng tiền thuần không đổi dấu trong suốt vòng đời dự án (ví dụ: chỉ có dòng tiền dương).")
+
+        except Exception as e:
+            st.error(f"Có lỗi xảy ra khi tính toán chỉ số: {e}. Vui lòng kiểm tra các thông số đầu vào và WACC.")
 
 
     else: